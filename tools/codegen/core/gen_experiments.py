@@ -22,27 +22,68 @@ Experiment definitions are in src/core/lib/experiments/experiments.yaml
 
 from __future__ import print_function
 
+import argparse
 import collections
-import ctypes
+import contextlib
 import datetime
+import io
 import json
-import math
 import os
 import re
 import sys
 
 import yaml
 
-# TODO(ctiller): if we ever add another argument switch this to argparse
-check_dates = True
-if sys.argv[1:] == ["--check"]:
-    check_dates = False  # for formatting checks we don't verify expiry dates
-
-with open('src/core/lib/experiments/experiments.yaml') as f:
-    attrs = yaml.safe_load(f.read())
-
-with open('src/core/lib/experiments/rollouts.yaml') as f:
-    rollouts = yaml.safe_load(f.read())
+argp = argparse.ArgumentParser(description='Generate experiment code.')
+argp.add_argument(
+    '--check',
+    action='store_true',
+    help='formatting check only: do not verify experiment expiry dates')
+argp.add_argument('--no-cache',
+                  action='store_true',
+                  help='always parse the yaml sources, ignoring cached json')
+args = argp.parse_args()
+check_dates = not args.check
+
+# Prefer the libyaml-backed loader when it is available; it is much faster
+# than the pure python one.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_yaml(path):
+    """Load a yaml file, going through a json sidecar cache when possible.
+
+    The parsed contents are stored in <path>.cache.json together with the
+    mtime and size of the yaml they came from, and are reused only while both
+    still match exactly.
+    """
+    cache_path = path + '.cache.json'
+    source_stat = os.stat(path)
+    source = [source_stat.st_mtime_ns, source_stat.st_size]
+    if not args.no_cache:
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache['source'] == source:
+                return cache['data']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # missing or corrupt cache: fall back to parsing the yaml
+    with open(path) as f:
+        result = yaml.load(f, Loader=_YAML_LOADER)
+    if not args.no_cache:
+        # the cache is an optimization only: skip it if the yaml holds values
+        # json cannot represent (eg. dates) or it cannot be written
+        try:
+            cached = json.dumps({'source': source, 'data': result})
+            with open(cache_path, 'w') as f:
+                f.write(cached)
+        except (OSError, TypeError):
+            pass
+    return result
+
+
+attrs = load_yaml('src/core/lib/experiments/experiments.yaml')
+rollouts = load_yaml('src/core/lib/experiments/rollouts.yaml')
 
 DEFAULTS = {
     'broken': 'false',
@@ -72,10 +113,13 @@ BZL_LIST_FOR_DEFAULTS = {
     'debug': 'dbg',
 }
 
+# fields every experiment in experiments.yaml must set (besides its name)
+REQUIRED_FIELDS = frozenset(('description', 'owner', 'expiry'))
+
 error = False
 today = datetime.date.today()
 two_quarters_from_now = today + datetime.timedelta(days=180)
-experiment_annotation = 'gRPC experiments:'
+experiment_names = []
 for rollout_attr in rollouts:
     if 'name' not in rollout_attr:
         print("experiment with no name: %r" % attr)
@@ -93,21 +137,27 @@ for attr in attrs:
         print("experiment with no name: %r" % attr)
         error = True
         continue  # can't run other diagnostics because we don't know a name
-    if 'description' not in attr:
-        print("no description for experiment %s" % attr['name'])
-        error = True
-    if 'owner' not in attr:
-        print("no owner for experiment %s" % attr['name'])
-        error = True
-    if 'expiry' not in attr:
-        print("no expiry for experiment %s" % attr['name'])
+    missing = REQUIRED_FIELDS - attr.keys()
+    if missing:
+        print("experiment %s is missing: %s" %
+              (attr['name'], ', '.join(sorted(missing))))
         error = True
+        if 'expiry' in missing:
+            continue
     if attr['name'] == 'monitoring_experiment':
         if attr['expiry'] != 'never-ever':
             print("monitoring_experiment should never expire")
             error = True
     else:
-        expiry = datetime.datetime.strptime(attr['expiry'], '%Y/%m/%d').date()
+        # parse YYYY/MM/DD by hand: strptime is slow for this simple format
+        try:
+            year, month, day = str(attr['expiry']).split('/')
+            expiry = datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            print("invalid expiry for experiment %s: %r" %
+                  (attr['name'], attr['expiry']))
+            error = True
+            continue
         if check_dates:
             if expiry < today:
                 print("experiment %s expired on %s" %
@@ -118,8 +168,10 @@ for attr in attrs:
                       (attr['name'], attr['expiry']))
                 print("expiry should be no more than two quarters from now")
                 error = True
-            experiment_annotation += attr['name'] + ':0,'
+            experiment_names.append(attr['name'])
 
+experiment_annotation = 'gRPC experiments:' + ''.join(
+    name + ':0,' for name in experiment_names)
 if len(experiment_annotation) > 2000:
     print("comma-delimited string of experiments is too long")
     error = True
@@ -127,38 +179,43 @@ if len(experiment_annotation) > 2000:
 if error:
     sys.exit(1)
 
+# octal escapes for every byte that cannot appear verbatim in a C string
+C_ESCAPES = {
+    b: ('\\%03o' % b).encode('ascii')
+    for b in range(256)
+    if not (32 <= b < 127) or b in b'\\"'
+}
+C_ESCAPE_RE = re.compile(rb'[^ -~]|["\\]')
+
+
+def escape_byte(match):
+    return C_ESCAPES[match.group(0)[0]]
+
 
 def c_str(s, encoding='ascii'):
     if isinstance(s, str):
         s = s.encode(encoding)
-    result = ''
-    for c in s:
-        c = chr(c) if isinstance(c, int) else c
-        if not (32 <= ord(c) < 127) or c in ('\\', '"'):
-            result += '\\%03o' % ord(c)
-        else:
-            result += c
-    return '"' + result + '"'
+    escaped = C_ESCAPE_RE.sub(escape_byte, s)
+    return '"' + escaped.decode('ascii') + '"'
 
 
 def snake_to_pascal(s):
-    return ''.join(x.capitalize() for x in s.split('_'))
+    # str.title() would be shorter, but it also capitalizes letters following
+    # digits (ipv6only -> Ipv6Only), which would rename generated functions.
+    return ''.join([x.capitalize() for x in s.split('_')])
 
 
 # utility: print a big comment block into a set of files
 def put_banner(files, banner, prefix):
+    text = ''.join('%s %s\n' % (prefix, line) if line else prefix + '\n'
+                   for line in banner) + '\n'
     for f in files:
-        for line in banner:
-            if not line:
-                print(prefix, file=f)
-            else:
-                print('%s %s' % (prefix, line), file=f)
-        print(file=f)
+        f.write(text)
 
 
-def put_copyright(file, prefix):
-    # copy-paste copyright notice from this file
-    with open(sys.argv[0]) as my_source:
+def extract_copyright(path):
+    """Return the copyright notice at the top of a python source file."""
+    with open(path) as my_source:
         copyright = []
         for line in my_source:
             if line[0] != '#':
@@ -171,17 +228,109 @@ def put_copyright(file, prefix):
             if line[0] != '#':
                 break
             copyright.append(line)
-        put_banner([file], [line[2:].rstrip() for line in copyright], prefix)
+    return [line[2:].rstrip() for line in copyright]
+
+
+# copy-paste copyright notice from this file
+COPYRIGHT = extract_copyright(sys.argv[0])
+
+
+def put_copyright(file, prefix):
+    put_banner([file], COPYRIGHT, prefix)
+
+
+@contextlib.contextmanager
+def buffered_output(path):
+    """Collect generated text in memory and write it to path in one go."""
+    buf = io.StringIO()
+    yield buf
+    with open(path, 'w') as f:
+        f.write(buf.getvalue())
+
+
+rollouts_by_name = {
+    rollout_attr['name']: rollout_attr for rollout_attr in rollouts
+}
 
 
 def get_rollout_attr_for_experiment(name):
-    for rollout_attr in rollouts:
-        if rollout_attr['name'] == name:
-            return rollout_attr
+    rollout_attr = rollouts_by_name.get(name)
+    if rollout_attr is not None:
+        return rollout_attr
     print('WARNING. experiment: %r has no rollout config. Disabling it.' % name)
     return {'name': name, 'default': 'false'}
 
 
+# everything the generators need about one experiment, computed once
+Experiment = collections.namedtuple(
+    'Experiment',
+    'attr rollout_attr pascal upper c_name c_description allow_in_fuzzing')
+
+
+def render_experiment(attr):
+    name = attr['name']
+    return Experiment(
+        attr, get_rollout_attr_for_experiment(name), snake_to_pascal(name),
+        name.upper(), c_str(name), c_str(attr['description']),
+        'true' if attr.get('allow_in_fuzzing_config', True) else 'false')
+
+
+rendered = [render_experiment(attr) for attr in attrs]
+
+
+def generate_sections(experiments):
+    """Generate the per-experiment sections of all outputs in a single pass.
+
+    Returns the header's final and runtime definitions, the .cc descriptions
+    and metadata entries, and the bzl map of default -> tag -> experiments.
+    """
+    # bind the lookup tables locally: this loop runs once per experiment
+    final_define = FINAL_DEFINE
+    final_return = FINAL_RETURN
+    defaults = DEFAULTS
+    final_defs = io.StringIO()  # experiments.h, GRPC_EXPERIMENTS_ARE_FINAL
+    runtime_defs = io.StringIO()  # experiments.h, tunable at runtime
+    descriptions = io.StringIO()  # experiments.cc, description strings
+    metadata = io.StringIO()  # experiments.cc, g_experiment_metadata entries
+    bzl_to_tags_to_experiments = dict((key, collections.defaultdict(list))
+                                      for key in BZL_LIST_FOR_DEFAULTS.keys()
+                                      if key is not None)
+    for i, experiment in enumerate(experiments):
+        attr = experiment.attr
+        name = attr['name']
+        default = experiment.rollout_attr['default']
+        define_fmt = final_define[default]
+        if define_fmt:
+            print(define_fmt %
+                  ("GRPC_EXPERIMENT_IS_INCLUDED_%s" % experiment.upper),
+                  file=final_defs)
+        print("inline bool Is%sEnabled() { %s }" %
+              (experiment.pascal, final_return[default]),
+              file=final_defs)
+        print("#define GRPC_EXPERIMENT_IS_INCLUDED_%s" % experiment.upper,
+              file=runtime_defs)
+        print("inline bool Is%sEnabled() { return IsExperimentEnabled(%d); }" %
+              (experiment.pascal, i),
+              file=runtime_defs)
+        print("const char* const description_%s = %s;" %
+              (name, experiment.c_description),
+              file=descriptions)
+        print("const char* const additional_constraints_%s = \"\";" % name,
+              file=descriptions)
+        print("  {%s, description_%s, additional_constraints_%s, %s, %s}," %
+              (experiment.c_name, name, name, defaults[default],
+               experiment.allow_in_fuzzing),
+              file=metadata)
+        for tag in attr['test_tags']:
+            bzl_to_tags_to_experiments[default][tag].append(name)
+    return (final_defs.getvalue(), runtime_defs.getvalue(),
+            descriptions.getvalue(), metadata.getvalue(),
+            bzl_to_tags_to_experiments)
+
+
+(final_defs, runtime_defs, descriptions, metadata,
+ bzl_to_tags_to_experiments) = generate_sections(rendered)
+
 WTF = """
 This file contains the autogenerated parts of the experiments API.
 
@@ -215,7 +364,7 @@ If you are using the Bazel build system, that macro can be configured with
 --define=grpc_experiments_are_final=true
 """
 
-with open('src/core/lib/experiments/experiments.h', 'w') as H:
+with buffered_output('src/core/lib/experiments/experiments.h') as H:
     put_copyright(H, "//")
 
     put_banner(
@@ -234,23 +383,9 @@ with open('src/core/lib/experiments/experiments.h', 'w') as H:
     print("namespace grpc_core {", file=H)
     print(file=H)
     print("#ifdef GRPC_EXPERIMENTS_ARE_FINAL", file=H)
-    for i, attr in enumerate(attrs):
-        rollout_attr = get_rollout_attr_for_experiment(attr['name'])
-        define_fmt = FINAL_DEFINE[rollout_attr['default']]
-        if define_fmt:
-            print(define_fmt %
-                  ("GRPC_EXPERIMENT_IS_INCLUDED_%s" % attr['name'].upper()),
-                  file=H)
-        print("inline bool Is%sEnabled() { %s }" % (snake_to_pascal(
-            attr['name']), FINAL_RETURN[rollout_attr['default']]),
-              file=H)
+    H.write(final_defs)
     print("#else", file=H)
-    for i, attr in enumerate(attrs):
-        print("#define GRPC_EXPERIMENT_IS_INCLUDED_%s" % attr['name'].upper(),
-              file=H)
-        print("inline bool Is%sEnabled() { return IsExperimentEnabled(%d); }" %
-              (snake_to_pascal(attr['name']), i),
-              file=H)
+    H.write(runtime_defs)
     print(file=H)
     print("constexpr const size_t kNumExperiments = %d;" % len(attrs), file=H)
     print(
@@ -262,7 +397,7 @@ with open('src/core/lib/experiments/experiments.h', 'w') as H:
     print(file=H)
     print("#endif  // GRPC_SRC_CORE_LIB_EXPERIMENTS_EXPERIMENTS_H", file=H)
 
-with open('src/core/lib/experiments/experiments.cc', 'w') as C:
+with buffered_output('src/core/lib/experiments/experiments.cc') as C:
     put_copyright(C, "//")
 
     put_banner(
@@ -275,52 +410,33 @@ with open('src/core/lib/experiments/experiments.cc', 'w') as C:
     print(file=C)
     print("#ifndef GRPC_EXPERIMENTS_ARE_FINAL", file=C)
     print("namespace {", file=C)
-    for attr in attrs:
-        print("const char* const description_%s = %s;" %
-              (attr['name'], c_str(attr['description'])),
-              file=C)
-        print("const char* const additional_constraints_%s = \"\";" %
-              attr['name'],
-              file=C)
-    have_defaults = set(
-        DEFAULTS[rollout_attr['default']] for rollout_attr in rollouts)
-    if 'kDefaultForDebugOnly' in have_defaults:
+    C.write(descriptions)
+    if any(rollout_attr['default'] == 'debug' for rollout_attr in rollouts):
         print("#ifdef NDEBUG", file=C)
-        if 'kDefaultForDebugOnly' in have_defaults:
-            print("const bool kDefaultForDebugOnly = false;", file=C)
+        print("const bool kDefaultForDebugOnly = false;", file=C)
         print("#else", file=C)
-        if 'kDefaultForDebugOnly' in have_defaults:
-            print("const bool kDefaultForDebugOnly = true;", file=C)
+        print("const bool kDefaultForDebugOnly = true;", file=C)
         print("#endif", file=C)
     print("}", file=C)
     print(file=C)
     print("namespace grpc_core {", file=C)
     print(file=C)
     print("const ExperimentMetadata g_experiment_metadata[] = {", file=C)
-    for attr in attrs:
-        rollout_attr = get_rollout_attr_for_experiment(attr['name'])
-        print(
-            "  {%s, description_%s, additional_constraints_%s, %s, %s}," %
-            (c_str(attr['name']), attr['name'], attr['name'],
-             DEFAULTS[rollout_attr['default']],
-             'true' if attr.get('allow_in_fuzzing_config', True) else 'false'),
-            file=C)
+    C.write(metadata)
     print("};", file=C)
     print(file=C)
     print("}  // namespace grpc_core", file=C)
     print("#endif", file=C)
 
-bzl_to_tags_to_experiments = dict((key, collections.defaultdict(list))
-                                  for key in BZL_LIST_FOR_DEFAULTS.keys()
-                                  if key is not None)
-
-for attr in attrs:
-    rollout_attr = get_rollout_attr_for_experiment(attr['name'])
-    for tag in attr['test_tags']:
-        bzl_to_tags_to_experiments[rollout_attr['default']][tag].append(
-            attr['name'])
+# [(bzl list, [(tag, [experiment])])], fully sorted ahead of emission
+bzl_lists = sorted(
+    (BZL_LIST_FOR_DEFAULTS[default],
+     sorted((tag, sorted(experiments))
+            for tag, experiments in tags_to_experiments.items()))
+    for default, tags_to_experiments in bzl_to_tags_to_experiments.items()
+    if BZL_LIST_FOR_DEFAULTS[default] is not None)
 
-with open('bazel/experiments.bzl', 'w') as B:
+with buffered_output('bazel/experiments.bzl') as B:
     put_copyright(B, "#")
 
     put_banner(
@@ -332,18 +448,13 @@ with open('bazel/experiments.bzl', 'w') as B:
         "\"\"\"Dictionary of tags to experiments so we know when to test different experiments.\"\"\"",
         file=B)
 
-    bzl_to_tags_to_experiments = sorted(
-        (BZL_LIST_FOR_DEFAULTS[default], tags_to_experiments)
-        for default, tags_to_experiments in bzl_to_tags_to_experiments.items()
-        if BZL_LIST_FOR_DEFAULTS[default] is not None)
-
     print(file=B)
     print("EXPERIMENTS = {", file=B)
-    for key, tags_to_experiments in bzl_to_tags_to_experiments:
+    for key, tags_to_experiments in bzl_lists:
         print("    \"%s\": {" % key, file=B)
-        for tag, experiments in sorted(tags_to_experiments.items()):
+        for tag, experiments in tags_to_experiments:
             print("        \"%s\": [" % tag, file=B)
-            for experiment in sorted(experiments):
+            for experiment in experiments:
                 print("            \"%s\"," % experiment, file=B)
             print("        ],", file=B)
         print("    },", file=B)
@@ -15,7 +15,12 @@
 
 set -e
 cd $(dirname $0)/../..
-tools/codegen/core/gen_experiments.py --check
+if [[ $# == 1 && $1 == '--check' ]]; then
+    # never trust a stale parse cache when verifying generated code
+    tools/codegen/core/gen_experiments.py --check --no-cache
+else
+    tools/codegen/core/gen_experiments.py --check
+fi
 # clang format
 TEST='' \
     CHANGED_FILES="$(git status --porcelain | awk '{print $2}' | tr '\n' ' ')" \